@@ -1,93 +1,158 @@
-import os, sqlite3, pandas as pd
+import os, sqlite3, threading, functools, itertools, pandas as pd
 from typing import Dict, Any, Tuple, List, Optional
 from datetime import datetime
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "..", "mat.db")
 
+# ---------- conexión ----------
+# Una conexión por hilo (webhook + scheduler comparten proceso): abrir/cerrar
+# por consulta pagaba open()+fsync en cada KPI. WAL permite lectores
+# concurrentes sin bloquear al escritor.
+_local = threading.local()
+
+def _get_conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-20000;
+        """)
+        _local.conn = conn
+    return conn
+
 # ---------- bootstrap / schema ----------
 def ensure_schema():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
+    # Se invoca una sola vez al arranque (startup de main.py).
+    conn = _get_conn()
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS user_sessions(
         chat_id     INTEGER PRIMARY KEY,
         report_time TEXT,
         last_seen_at TEXT
     )""")
-    conn.commit(); conn.close()
+
+_SQL_TYPES = {"i": "INTEGER", "f": "REAL"}
+
+def _bulk_replace(conn, table: str, df):
+    # Carga por lotes: executemany dentro de UNA transacción en vez del
+    # INSERT fila-a-fila (con fsync cada uno) que hacía to_sql.
+    cols = ", ".join(f'"{c}" {_SQL_TYPES.get(df[c].dtype.kind, "TEXT")}' for c in df.columns)
+    conn.execute(f'DROP TABLE IF EXISTS {table}')
+    conn.execute(f'CREATE TABLE {table} ({cols})')
+    conn.execute("BEGIN")
+    conn.executemany(
+        f'INSERT INTO {table} VALUES ({",".join("?" * len(df.columns))})',
+        df.itertuples(index=False, name=None),
+    )
+    conn.execute("COMMIT")
 
 def load_csv_to_sqlite(assets_csv: str, wo_csv: str):
     ensure_schema()
-    conn = sqlite3.connect(DB_PATH)
-    pd.read_csv(assets_csv).to_sql("assets", conn, if_exists="replace", index=False)
+    conn = _get_conn()
+    _bulk_replace(conn, "assets", pd.read_csv(assets_csv))
 
     dfwo = pd.read_csv(wo_csv)
     if "mttr_hours" not in dfwo.columns and "labor_hours" in dfwo.columns:
         dfwo["mttr_hours"] = dfwo["labor_hours"]
     if "cost_total" not in dfwo.columns:
         dfwo["cost_total"] = dfwo.get("cost_parts", 0) + dfwo.get("cost_labor", 0)
-    dfwo.to_sql("work_orders", conn, if_exists="replace", index=False)
+    _bulk_replace(conn, "work_orders", dfwo)
     conn.execute("CREATE INDEX IF NOT EXISTS idx_wo_asset ON work_orders(asset_id)")
-    conn.commit(); conn.close()
+    # Índices para los filtros/agrupaciones calientes de los KPIs: sin ellos
+    # cada consulta del reporte diario hace full-scan de work_orders.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wo_status_type ON work_orders(status, type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wo_opened_ym ON work_orders(substr(opened_at,1,7))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wo_tech_status ON work_orders(technician COLLATE NOCASE, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wo_closed ON work_orders(closed_at) WHERE closed_at IS NOT NULL")
+    if _table_has_column(conn, "assets", "site"):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_site ON assets(site)")
+    if _table_has_column(conn, "assets", "area"):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_assets_area ON assets(area)")
+
+    # El esquema/los valores conocidos pueden haber cambiado con el CSV nuevo
+    global _KNOWN_CACHE
+    _KNOWN_CACHE = None
+    _has_column.cache_clear()
 
 # ---------- subscriptions ----------
 def update_last_seen(chat_id: int):
-    ensure_schema()
     now = datetime.utcnow().isoformat(timespec="seconds")
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""
+    _get_conn().execute("""
         INSERT INTO user_sessions(chat_id, last_seen_at) VALUES(?, ?)
         ON CONFLICT(chat_id) DO UPDATE SET last_seen_at=excluded.last_seen_at
     """, (chat_id, now))
-    conn.commit(); conn.close()
 
 def set_report_time(chat_id: int, hhmm: str):
-    ensure_schema()
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""
+    _get_conn().execute("""
         INSERT INTO user_sessions(chat_id, report_time) VALUES(?,?)
         ON CONFLICT(chat_id) DO UPDATE SET report_time=excluded.report_time
     """, (chat_id, hhmm))
-    conn.commit(); conn.close()
 
 def get_report_time(chat_id: int) -> Optional[str]:
-    ensure_schema()
-    conn = sqlite3.connect(DB_PATH)
-    r = conn.execute("SELECT report_time FROM user_sessions WHERE chat_id=?", (chat_id,)).fetchone()
-    conn.close()
+    r = _get_conn().execute("SELECT report_time FROM user_sessions WHERE chat_id=?", (chat_id,)).fetchone()
     return r[0] if r and r[0] else None
 
 def all_chat_ids_with_time() -> List[Tuple[int, str]]:
-    ensure_schema()
-    conn = sqlite3.connect(DB_PATH)
-    rows = conn.execute("SELECT chat_id, report_time FROM user_sessions WHERE report_time IS NOT NULL").fetchall()
-    conn.close()
-    return rows
+    return _get_conn().execute("SELECT chat_id, report_time FROM user_sessions WHERE report_time IS NOT NULL").fetchall()
+
+def due_chat_ids() -> List[int]:
+    # Chats cuyo report_time (HH:MM, hora local, como los CronTriggers que
+    # reemplazó) coincide con el minuto actual: una sola consulta por tick
+    # del scheduler, no un job por suscriptor.
+    sql = "SELECT chat_id FROM user_sessions WHERE substr(report_time,1,5) = strftime('%H:%M','now','localtime')"
+    return list(itertools.chain.from_iterable(_get_conn().execute(sql)))
 
 # ---------- helpers de filtros ----------
-def _filters_to_where(slots: Dict[str, Any]) -> Tuple[str, list]:
-    clauses, params = [], []
-    if slots.get("site"):
-        clauses.append("work_orders.asset_id IN (SELECT asset_id FROM assets WHERE site=?)"); params.append(slots["site"])
-    if slots.get("area"):
-        clauses.append("work_orders.asset_id IN (SELECT asset_id FROM assets WHERE area=?)"); params.append(slots["area"])
-    if slots.get("status"):
-        clauses.append("status=?"); params.append(slots["status"])
-    if slots.get("type"):
-        clauses.append("type=?"); params.append(slots["type"])
-    if slots.get("technician"):
-        clauses.append("LOWER(technician)=LOWER(?)"); params.append(slots["technician"])
-    if slots.get("date_from"):
-        clauses.append("date(substr(COALESCE(closed_at, opened_at),1,10)) >= date(?)"); params.append(slots["date_from"])
-    if slots.get("date_to"):
-        clauses.append("date(substr(COALESCE(closed_at, opened_at),1,10)) <= date(?)"); params.append(slots["date_to"])
-    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+_FILTER_CLAUSES = (
+    ("site",       "a.site=?"),
+    ("area",       "a.area=?"),
+    ("status",     "status=?"),
+    ("type",       "type=?"),
+    ("technician", "technician = ? COLLATE NOCASE"),
+    ("date_from",  "date(substr(COALESCE(closed_at, opened_at),1,10)) >= date(?)"),
+    ("date_to",    "date(substr(COALESCE(closed_at, opened_at),1,10)) <= date(?)"),
+)
+
+@functools.lru_cache(maxsize=256)
+def _where_template(shape: frozenset, join_assets: bool) -> Tuple[str, str, Tuple[str, ...]]:
+    # El SQL depende solo de QUÉ slots vienen (≤2^7 combinaciones): memoizar
+    # el template permite además que sqlite3 reutilice el statement preparado
+    # (su caché interno se indexa por texto SQL idéntico).
+    clauses = [(k, c) for k, c in _FILTER_CLAUSES if k in shape]
+    join_assets = join_assets or "site" in shape or "area" in shape
+    join = "JOIN assets a ON a.asset_id = work_orders.asset_id" if join_assets else ""
+    where = ("WHERE " + " AND ".join(c for _, c in clauses)) if clauses else ""
+    return join, where, tuple(k for k, _ in clauses)
+
+def _filters_to_where(slots: Dict[str, Any], join_assets: bool = False) -> Tuple[str, str, list]:
+    # Devuelve (join, where, params). site/area se resuelven con un único JOIN
+    # a assets en vez de dos subqueries IN; join_assets=True lo fuerza para
+    # consultas que ya necesitan columnas de assets (p.ej. top_downtime).
+    shape = frozenset(k for k, _ in _FILTER_CLAUSES if slots.get(k))
+    join, where, order = _where_template(shape, join_assets)
+    return join, where, [slots[k] for k in order]
+
+# sites/areas solo cambian al recargar el CSV: cachear en proceso y validar
+# contra el mtime del archivo por si otro proceso regenera la DB.
+_KNOWN_CACHE: Optional[Tuple[float, Tuple[List[str], List[str]]]] = None
 
 def query_known_values() -> Tuple[List[str], List[str]]:
-    conn = sqlite3.connect(DB_PATH)
-    sites = [r[0] for r in conn.execute("SELECT DISTINCT site FROM assets WHERE site IS NOT NULL")] if _table_has_column(conn,"assets","site") else []
-    areas = [r[0] for r in conn.execute("SELECT DISTINCT area FROM assets WHERE area IS NOT NULL")] if _table_has_column(conn,"assets","area") else []
-    conn.close(); return sites, areas
+    global _KNOWN_CACHE
+    try:
+        mtime = os.stat(DB_PATH).st_mtime
+    except OSError:
+        mtime = 0.0
+    if _KNOWN_CACHE is not None and _KNOWN_CACHE[0] == mtime:
+        return _KNOWN_CACHE[1]
+    conn = _get_conn()
+    sites = list(itertools.chain.from_iterable(conn.execute("SELECT DISTINCT site FROM assets WHERE site IS NOT NULL"))) if _has_column("assets","site") else []
+    areas = list(itertools.chain.from_iterable(conn.execute("SELECT DISTINCT area FROM assets WHERE area IS NOT NULL"))) if _has_column("assets","area") else []
+    _KNOWN_CACHE = (mtime, (sites, areas))
+    return sites, areas
 
 def _table_has_column(conn, table, col) -> bool:
     try:
@@ -96,106 +161,128 @@ def _table_has_column(conn, table, col) -> bool:
     except sqlite3.OperationalError:
         return False
 
+@functools.lru_cache(maxsize=None)
+def _has_column(table: str, col: str) -> bool:
+    # El esquema es estático por proceso; load_csv_to_sqlite limpia el caché.
+    return _table_has_column(_get_conn(), table, col)
+
 # ---------- KPIs ----------
+def _scalar(sql: str, params) -> Any:
+    # fetchval: agregados de una sola celda sin list-comp ni tupla intermedia
+    return _get_conn().execute(sql, params).fetchone()[0]
+
 def kpi_mttr(slots: Dict[str, Any]) -> float:
-    where, params = _filters_to_where({**slots, "status": "Cerrada"})
-    sql = f"SELECT AVG(COALESCE(mttr_hours, labor_hours)) FROM work_orders {where}"
-    conn = sqlite3.connect(DB_PATH); cur = conn.execute(sql, params)
-    val = cur.fetchone()[0]; conn.close(); return round(val or 0.0, 2)
+    join, where, params = _filters_to_where({**slots, "status": "Cerrada"})
+    sql = f"SELECT AVG(COALESCE(mttr_hours, labor_hours)) FROM work_orders {join} {where}"
+    return round(_scalar(sql, params) or 0.0, 2)
 
 def kpi_backlog_days(slots: Dict[str, Any]) -> float:
-    where, params = _filters_to_where({**slots, "status": None})
-    where = f"{where} {' AND ' if where else 'WHERE '} status!='Cerrada'"
-    sql = f"SELECT opened_at FROM work_orders {where}"
-    conn = sqlite3.connect(DB_PATH); rows = [r[0] for r in conn.execute(sql, params)]
-    conn.close()
-    if not rows: return 0.0
-    now = datetime.utcnow(); days=[]
-    for s in rows:
-        try: days.append((now - datetime.fromisoformat(s)).days)
-        except: pass
-    return round(sum(days)/len(days), 2) if days else 0.0
+    # Edad promedio (días) de las órdenes no cerradas; el promedio lo calcula
+    # SQLite directamente, sin materializar filas ni parsear fechas en Python.
+    join, where, params = _filters_to_where({**slots, "status": None})
+    where = f"{where} {' AND ' if where else 'WHERE '} status!='Cerrada' AND opened_at IS NOT NULL"
+    sql = f"SELECT AVG(julianday('now') - julianday(opened_at)) FROM work_orders {join} {where}"
+    return round(_scalar(sql, params) or 0.0, 2)
 
 def kpi_pm_compliance(slots: Dict[str, Any], window_days: int = 31) -> float:
-    where, params = _filters_to_where({**slots, "type": "PM"})
-    sql = f"SELECT due_date, closed_at FROM work_orders {where}"
-    conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params).fetchall(); conn.close()
-    if not rows: return 0.0
-    from datetime import date, timedelta
+    join, where, params = _filters_to_where({**slots, "type": "PM"})
+    from datetime import date
     if slots.get("date_from") and slots.get("date_to"):
         start = date.fromisoformat(slots["date_from"])
     else:
         start = date.today().replace(day=1)
-    due = [(d,c) for d,c in rows if d and d >= str(start)]
-    if not due: return 0.0
-    good = sum(1 for d,c in due if c and c[:10] <= d)
-    return round(100.0 * good / len(due), 2)
+    sql = f"""SELECT AVG(CASE WHEN closed_at IS NOT NULL AND substr(closed_at,1,10) <= due_date
+                              THEN 100.0 ELSE 0.0 END)
+              FROM work_orders {join} {where} AND due_date >= ?"""
+    return round(_scalar(sql, params + [start.isoformat()]) or 0.0, 2)
 
 def kpi_costs_monthly(slots: Dict[str, Any], months: int = 6):
-    # Si se especifica mes (date_from/to en el mismo mes) -> devolver SOLO ese mes
+    # Si se especifica mes (date_from/to en el mismo mes) -> devolver SOLO ese mes.
+    # El predicado va en WHERE (no HAVING) para que sea un point-lookup sobre
+    # el índice de expresión idx_wo_opened_ym en vez de agrupar y descartar.
     if slots.get("date_from") and slots.get("date_to"):
         year_month = slots["date_from"][:7]
-        where, params = _filters_to_where(slots)
+        join, where, params = _filters_to_where(slots)
         sql = f"""
             SELECT substr(opened_at,1,7) AS ym, SUM(cost_total)
-            FROM work_orders {where}
-            GROUP BY ym HAVING ym = ?
-            ORDER BY ym DESC
+            FROM work_orders {join} {where} AND substr(opened_at,1,7) = ?
+            GROUP BY ym
         """
-        conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params + [year_month]).fetchall(); conn.close()
-        return rows
+        return _get_conn().execute(sql, params + [year_month]).fetchall()
 
     # default: últimos N meses del rango filtrado
-    where, params = _filters_to_where(slots)
+    join, where, params = _filters_to_where(slots)
     sql = f"""
-        SELECT substr(opened_at,1,7) AS ym, SUM(cost_total)
-        FROM work_orders {where}
+        SELECT ym, SUM(cost_total)
+        FROM (SELECT substr(opened_at,1,7) AS ym, cost_total
+              FROM work_orders {join} {where})
         GROUP BY ym ORDER BY ym DESC LIMIT ?
     """
-    conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params + [months]).fetchall(); conn.close()
-    return rows
+    return _get_conn().execute(sql, params + [months]).fetchall()
 
 def top_downtime(slots: Dict[str, Any], n: int = 5):
-    where, params = _filters_to_where(slots)
+    join, where, params = _filters_to_where(slots, join_assets=True)
     sql = f"""SELECT a.asset_id, a.name, SUM(work_orders.downtime_hours) as dt
-              FROM work_orders JOIN assets a ON a.asset_id = work_orders.asset_id
+              FROM work_orders {join}
               {where}
               GROUP BY a.asset_id, a.name ORDER BY dt DESC LIMIT ?"""
-    conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params + [n]).fetchall(); conn.close()
-    return rows
+    return _get_conn().execute(sql, params + [n]).fetchall()
 
 def status_counts(slots: Dict[str, Any]):
-    where, params = _filters_to_where(slots)
-    sql = f"SELECT status, COUNT(*) FROM work_orders {where} GROUP BY status"
-    conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params).fetchall(); conn.close()
+    join, where, params = _filters_to_where(slots)
+    sql = f"SELECT status, COUNT(*) FROM work_orders {join} {where} GROUP BY status"
+    rows = _get_conn().execute(sql, params).fetchall()
     d = {"Abierta":0,"En Progreso":0,"Cerrada":0}
     for s,c in rows: d[s]=c
     d["Total"]=sum(d.values()); return d
 
 def kpi_mtbf(slots: Dict[str, Any]) -> float:
-    # MTBF simple: diferencia promedio (horas) entre fechas de fallas (CM cerradas) ordenadas
+    # MTBF simple: diferencia promedio (horas) entre fechas de fallas (CM cerradas).
+    # (max-min)/(n-1) es algebraicamente igual al promedio de deltas de la
+    # secuencia ordenada, así que no hace falta ORDER BY ni loop en Python.
     wslots = {**slots, "type":"CM", "status":"Cerrada"}
-    where, params = _filters_to_where(wslots)
-    sql = f"SELECT closed_at FROM work_orders {where} AND closed_at IS NOT NULL ORDER BY closed_at"
-    conn = sqlite3.connect(DB_PATH); rows = [r[0] for r in conn.execute(sql, params)]
-    conn.close()
-    times = []
-    prev = None
-    for s in rows:
-        try:
-            t = datetime.fromisoformat(s)
-            if prev: times.append((t - prev).total_seconds()/3600.0)
-            prev = t
-        except: pass
-    if not times: return 0.0
-    return round(sum(times)/len(times), 2)
+    join, where, params = _filters_to_where(wslots)
+    sql = f"""SELECT (julianday(MAX(closed_at)) - julianday(MIN(closed_at))) * 24.0
+                     / NULLIF(COUNT(*) - 1, 0)
+              FROM work_orders {join} {where} AND closed_at IS NOT NULL"""
+    return round(_scalar(sql, params) or 0.0, 2)
+
+# ---------- reporte diario ----------
+def daily_report_bundle(slots: Dict[str, Any]) -> Dict[str, Any]:
+    # Las 5 lecturas del reporte diario comparten una sola transacción de
+    # lectura: un único snapshot/lock en vez de 5 ciclos independientes.
+    conn = _get_conn()
+    conn.execute("BEGIN DEFERRED")
+    try:
+        return {
+            "mttr": kpi_mttr(slots),
+            "backlog": kpi_backlog_days(slots),
+            "pm": kpi_pm_compliance(slots),
+            "states": status_counts(slots),
+            "top_downtime": top_downtime(slots),
+        }
+    finally:
+        conn.execute("COMMIT")
 
 # --------- Técnicos ----------
+def tech_all_counts(slots: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    # Conteos de TODOS los técnicos en un solo GROUP BY (technician, status):
+    # evita lanzar tech_person_counts una vez por persona (N+1).
+    join, where, params = _filters_to_where({**slots, "technician": None})
+    sql = f"""SELECT technician, status, COUNT(*) FROM work_orders {join} {where}
+              GROUP BY technician, status"""
+    out: Dict[str, Dict[str, int]] = {}
+    for tech, status, c in _get_conn().execute(sql, params):
+        d = out.setdefault(tech, {"Abierta":0,"En Progreso":0,"Cerrada":0,"Total":0})
+        d[status] = c
+        d["Total"] += c
+    return out
+
 def tech_person_counts(slots: Dict[str, Any], person: str):
     w = {**slots, "technician": person}
-    where, params = _filters_to_where(w)
-    sql = f"SELECT status, COUNT(*) FROM work_orders {where} GROUP BY status"
-    conn = sqlite3.connect(DB_PATH); rows = conn.execute(sql, params).fetchall(); conn.close()
+    join, where, params = _filters_to_where(w)
+    sql = f"SELECT status, COUNT(*) FROM work_orders {join} {where} GROUP BY status"
+    rows = _get_conn().execute(sql, params).fetchall()
     d = {"Abierta":0,"En Progreso":0,"Cerrada":0}
     for s,c in rows: d[s]=c
     d["Total"]=sum(d.values()); return d
@@ -1,10 +1,19 @@
 # formatters.py
-from datetime import datetime
+import functools
+from datetime import datetime, date
 from typing import Dict, Any, Iterable, Tuple, Optional
 
 
 # -------------- Helpers --------------
 
+@functools.lru_cache(maxsize=1)
+def _month_bounds(ordinal: int) -> Tuple[str, str]:
+    # Strings ISO de "1° del mes" y "hoy": se arman una vez por día (la
+    # clave ordinal invalida a medianoche) en vez de en cada formatter.
+    d = date.fromordinal(ordinal)
+    return d.replace(day=1).isoformat(), d.isoformat()
+
+
 def _period_label(slots: Optional[Dict[str, Any]]) -> str:
     """
     Devuelve:
@@ -20,15 +29,10 @@ def _period_label(slots: Optional[Dict[str, Any]]) -> str:
     if not df or not dt:
         return ""
 
-    try:
-        today = datetime.utcnow().date()
-        start = today.replace(day=1)
-        if df == start.isoformat() and dt == today.isoformat():
-            return " (Mes actual)"
-        return f" ({df} → {dt})"
-    except Exception:
-        # Si por algún motivo el parse falla, igual mostramos el rango crudo
-        return f" ({df} → {dt})"
+    month_start_iso, today_iso = _month_bounds(datetime.utcnow().date().toordinal())
+    if df == month_start_iso and dt == today_iso:
+        return " (Mes actual)"
+    return f" ({df} → {dt})"
 
 
 def _fmt_money(n: float) -> str:
@@ -114,12 +118,11 @@ def f_tech_summary(open_map: Dict[str, int], closed_map: Dict[str, int], slots:
     if not techs:
         return f"👷 Órdenes por técnico{lbl}: no hay datos."
 
-    lines = []
-    for t in techs:
-        o = open_map.get(t, 0)
-        c = closed_map.get(t, 0)
-        lines.append(f"• {t}: abiertas {o}, cerradas {c}")
-    return "👷 Órdenes por técnico" + lbl + ":\n" + "\n".join(lines)
+    body = "\n".join(
+        f"• {t}: abiertas {open_map.get(t, 0)}, cerradas {closed_map.get(t, 0)}"
+        for t in techs
+    )
+    return "👷 Órdenes por técnico" + lbl + ":\n" + body
 
 
 def f_tech_person(person: str, counts: dict, slots: dict) -> str:
@@ -135,33 +138,34 @@ def f_tech_person(person: str, counts: dict, slots: dict) -> str:
         f"• Cerradas: {closed}\n"
         f"• Total: {total}"
     )
+_DAILY_HEADER   = "📮 Reporte diario"
+_DAILY_NO_TOPDT = "Sin paradas registradas en el periodo."
+
 def f_daily_report(k_mttr: float, k_backlog: float, k_pm: float,
                    states: dict, topdt_rows, slots: dict | None = None) -> str:
     """
     Reporte compacto diario. Usa _period_label(slots) para indicar el periodo.
+    Se arma con lista + join (corre una vez por chat suscrito).
     """
     lbl = _period_label(slots or {})
-    # Estados
-    s_ab = states.get("Abierta", 0)
-    s_ep = states.get("En Progreso", 0)
-    s_ce = states.get("Cerrada", 0)
-    s_to = states.get("Total", 0)
-
     # Top downtime
     if topdt_rows:
-        lines = [f"- {aid} · {name}: {round(dt,1)} h" for aid, name, dt in topdt_rows]
-        top_block = "\n".join(lines)
+        top_block = "\n".join(f"- {aid} · {name}: {round(dt,1)} h" for aid, name, dt in topdt_rows)
     else:
-        top_block = "Sin paradas registradas en el periodo."
-
-    return (
-        f"📮 Reporte diario{lbl}\n"
-        f"• 🛠️ MTTR: {k_mttr} h\n"
-        f"• 📚 Backlog: {k_backlog} días\n"
-        f"• ✅ Cumplimiento PM: {k_pm}%\n"
-        f"• 📊 Estados: Abiertas {s_ab} · En Progreso {s_ep} · Cerradas {s_ce} · Total {s_to}\n"
-        f"• ⛔ Top downtime:\n{top_block}"
-    )
+        top_block = _DAILY_NO_TOPDT
+
+    parts = [
+        _DAILY_HEADER, lbl,
+        "\n• 🛠️ MTTR: ", str(k_mttr), " h",
+        "\n• 📚 Backlog: ", str(k_backlog), " días",
+        "\n• ✅ Cumplimiento PM: ", str(k_pm), "%",
+        "\n• 📊 Estados: Abiertas ", str(states.get("Abierta", 0)),
+        " · En Progreso ", str(states.get("En Progreso", 0)),
+        " · Cerradas ", str(states.get("Cerrada", 0)),
+        " · Total ", str(states.get("Total", 0)),
+        "\n• ⛔ Top downtime:\n", top_block,
+    ]
+    return "".join(parts)
 
 
 # -------------- (Opcional) MTBF --------------
@@ -2,18 +2,32 @@
 import os, json, logging, logging.handlers, re
 from datetime import datetime
 
-SECRET_PATTERNS = [
-    re.compile(r"(bot\d+:|AAG|AAH)[A-Za-z0-9_-]{20,}"),   # tokens tg (heurístico)
-    re.compile(r"[A-Za-z0-9]{24,}\.[A-Za-z0-9_-]{6,}\.[A-Za-z0-9_-]{27,}"), # estilo JWT
-]
+try:
+    import orjson
+    def _dumps(payload: dict) -> str:
+        return orjson.dumps(payload, default=str).decode()
+except ImportError:  # pragma: no cover - fallback stdlib
+    def _dumps(payload: dict) -> str:
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+# tokens tg (heurístico) | estilo JWT — una sola alternación: un solo scan
+_SECRET_RE = re.compile(
+    r"(?:(?:bot\d+:|AAG|AAH)[A-Za-z0-9_-]{20,})"
+    r"|(?:[A-Za-z0-9]{24,}\.[A-Za-z0-9_-]{6,}\.[A-Za-z0-9_-]{27,})"
+)
+
+# Match mínimo posible de _SECRET_RE: "AAG" + 20 chars = 23. El umbral se
+# declara junto al regex para que cualquier cambio de patrón lo revise.
+_SECRET_MIN_LEN = 23
 
 def _sanitize(value: str) -> str:
     if not isinstance(value, str):
         return value
-    masked = value
-    for p in SECRET_PATTERNS:
-        masked = p.sub("***", masked)
-    return masked
+    # Ningún secreto cabe en menos de _SECRET_MIN_LEN chars: evita el regex
+    # en el caso común sin dejar pasar el token más corto posible
+    if len(value) < _SECRET_MIN_LEN:
+        return value
+    return _SECRET_RE.sub("***", value)
 
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
@@ -26,12 +40,14 @@ class JsonFormatter(logging.Formatter):
         if record.exc_info:
             payload["exc"] = self.formatException(record.exc_info)
         if hasattr(record, "extra"):
-            # asegura que no explote por objetos raros
-            try:
-                payload["extra"] = json.loads(json.dumps(record.extra, default=str))
-            except Exception:
-                payload["extra"] = str(record.extra)
-        return json.dumps(payload, ensure_ascii=False)
+            payload["extra"] = record.extra
+        # un solo encode; default=str cubre objetos raros sin el round-trip
+        # loads(dumps(...)) que se hacía antes por cada línea de log
+        try:
+            return _dumps(payload)
+        except (TypeError, ValueError):
+            payload["extra"] = str(getattr(record, "extra", None))
+            return _dumps(payload)
 
 def setup_logging():
     log_dir  = os.environ.get("LOG_DIR", "logs")
@@ -1,7 +1,7 @@
-import os, httpx, logging
+import os, asyncio, httpx, logging, orjson
 from datetime import datetime
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
@@ -31,11 +31,30 @@ HELP_TEXT = (
     "• Hora diaria: /setreport 07:00"
 )
 
+UNKNOWN_TEXT = (
+    "Lo siento, no puedo ayudarte con esa solicitud. Por ahora solo puedo apoyar con: "
+    "MTTR, MTBF, Backlog, Cumplimiento PM, Costos, Top downtime, Estados y órdenes por técnico.\n\n"
+    "Ejemplos:\n• MTTR este mes\n• MTBF este mes\n• Costos septiembre\n• Cumplimiento PM agosto\n"
+    "• ¿Cuántas órdenes cerradas tiene Sebastian en septiembre?"
+)
+
+FAREWELL_TEXT = "¡Gracias! Me alegra ayudarte. Nos vemos mañana 👋"
+
+# Respuestas fijas pre-serializadas: solo falta anteponer el chat_id,
+# así el saludo/despedida/fallback no re-encodea el mismo texto cada vez.
+def _payload_tail(text: str) -> bytes:
+    return b'"text":' + orjson.dumps(text) + b"}"
+
+_HELP_TAIL     = _payload_tail(HELP_TEXT)
+_FAREWELL_TAIL = _payload_tail(FAREWELL_TEXT)
+_UNKNOWN_TAIL  = _payload_tail(UNKNOWN_TEXT)
+
 # --- App / Logging / Scheduler ---
 setup_logging()
 log = logging.getLogger("app")
 
-app = FastAPI()
+# orjson para los {"ok": True} del webhook: evita el encoder json stdlib
+app = FastAPI(default_response_class=ORJSONResponse)
 scheduler = AsyncIOScheduler()
 
 # --- Middleware de logging HTTP ---
@@ -55,38 +74,66 @@ async def add_logging(request: Request, call_next):
         return JSONResponse({"detail": "internal error"}, status_code=500)
 
 # --- Telegram send helper ---
+# Cliente único y persistente: reutiliza la conexión TCP/TLS hacia
+# api.telegram.org en vez de pagar el handshake en cada mensaje.
 async def send_message(chat_id: int, text: str):
     if not text:
         return
-    async with httpx.AsyncClient(timeout=15) as client:
-        await client.post(
-            f"{BASE_URL}/sendMessage",
-            json={"chat_id": chat_id, "text": text},
-        )
+    await app.state.tg_client.post(
+        "/sendMessage",
+        json={"chat_id": chat_id, "text": text},
+    )
+
+async def send_message_cached(chat_id: int, tail: bytes):
+    body = b'{"chat_id":%d,' % chat_id + tail
+    await app.state.tg_client.post(
+        "/sendMessage",
+        content=body,
+        headers={"Content-Type": "application/json"},
+    )
 
 # --- Lifecycle hooks ---
 @app.on_event("startup")
 async def _startup():
+    app.state.tg_client = httpx.AsyncClient(
+        base_url=BASE_URL,
+        timeout=15,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
     data.ensure_schema()
     scheduler.start()
-    # Cargar trabajos de reportes que estén guardados en DB
-    for chat_id, hhmm in data.all_chat_ids_with_time():
-        try:
-            hh, mm = map(int, hhmm.split(":"))
-            scheduler.add_job(
-                send_daily_report,
-                CronTrigger(hour=hh, minute=mm),
-                args=[chat_id],
-                id=f"rep_{chat_id}",
-                replace_existing=True,
-            )
-        except Exception:
-            pass
+    # Un solo tick por minuto que consulta quién está por recibir reporte:
+    # evita mantener (y recargar) un job de scheduler por suscriptor.
+    scheduler.add_job(_report_tick, CronTrigger(minute="*"), id="report_tick", replace_existing=True)
 
 @app.on_event("shutdown")
 async def _shutdown():
     if scheduler.running:
         scheduler.shutdown(wait=False)
+    client = getattr(app.state, "tg_client", None)
+    if client is not None:
+        await client.aclose()
+
+# Si no hay rango, por defecto “mes actual” (1..hoy)
+def _ensure_month_default(s: dict, month_start_iso: str, today_iso: str):
+    if not s.get("date_from") and not s.get("date_to"):
+        s["date_from"] = month_start_iso
+        s["date_to"]   = today_iso
+
+# --- Tick del scheduler: manda todos los reportes que tocan este minuto ---
+async def _report_tick():
+    due = data.due_chat_ids()
+    if not due:
+        return
+    # return_exceptions: un chat caído (timeout de httpx, etc.) no corta el
+    # envío al resto; cada falla se loguea por separado, como hacían los
+    # jobs por suscriptor.
+    results = await asyncio.gather(
+        *(send_daily_report(cid) for cid in due), return_exceptions=True
+    )
+    for cid, res in zip(due, results):
+        if isinstance(res, BaseException):
+            log.error("daily_report_failed", extra={"chat_id": cid, "error": repr(res)})
 
 # --- Daily report job (mes en curso) ---
 async def send_daily_report(chat_id: int):
@@ -95,15 +142,82 @@ async def send_daily_report(chat_id: int):
     start = today.replace(day=1)
     slots_month = {"date_from": start.isoformat(), "date_to": today.isoformat()}
 
-    k_mttr = data.kpi_mttr(slots_month)
-    k_back = data.kpi_backlog_days(slots_month)
-    k_pm   = data.kpi_pm_compliance(slots_month)
-    states = data.status_counts(slots_month)
-    topdt  = data.top_downtime(slots_month)
+    kpis = data.daily_report_bundle(slots_month)
 
-    txt = F.f_daily_report(k_mttr, k_back, k_pm, states, topdt, slots_month)
+    txt = F.f_daily_report(kpis["mttr"], kpis["backlog"], kpis["pm"],
+                           kpis["states"], kpis["top_downtime"], slots_month)
     await send_message(chat_id, txt)
 
+# --- Comandos (dispatch por primer token, sin cadena de startswith) ---
+async def _handle_version(chat_id: int, text: str):
+    await send_message(chat_id, version_text())
+
+async def _handle_setreport(chat_id: int, text: str):
+    parts = text.split()
+    if len(parts) != 2 or ":" not in parts[1]:
+        await send_message(chat_id, "⚠️ Formato de hora inválido. Usa HH:MM (ej. 07:00).")
+        return
+    try:
+        hh, mm = map(int, parts[1].split(":"))
+        # Antes validaba el CronTrigger al registrar el job; ahora que solo
+        # se guarda el string hay que rechazar horas imposibles aquí.
+        if not (0 <= hh < 24 and 0 <= mm < 60):
+            await send_message(chat_id, "⚠️ Hora fuera de rango. Usa HH:MM entre 00:00 y 23:59.")
+            return
+        hhmm = f"{hh:02d}:{mm:02d}"
+        data.set_report_time(chat_id, hhmm)
+        await send_message(chat_id, f"⏰ Hora de reporte establecida en {hhmm} (mes en curso).")
+    except Exception:
+        await send_message(chat_id, "⚠️ No pude interpretar esa hora. Usa HH:MM (ej. 07:00).")
+
+async def _handle_subscribe(chat_id: int, text: str):
+    hhmm = data.get_report_time(chat_id) or "07:00"
+    data.set_report_time(chat_id, hhmm)
+    await send_message(
+        chat_id,
+        f"🔔 Suscripción activada. Enviaré el reporte diario (mes en curso) a la hora configurada ({hhmm})."
+    )
+
+async def _handle_unsubscribe(chat_id: int, text: str):
+    data.set_report_time(chat_id, None)
+    await send_message(chat_id, "🔕 Suscripción cancelada. Ya no enviaré reportes diarios.")
+
+async def _handle_testrun(chat_id: int, text: str):
+    await send_daily_report(chat_id)
+
+_CMD_HANDLERS = {
+    "/version":     _handle_version,
+    "/setreport":   _handle_setreport,
+    "/subscribe":   _handle_subscribe,
+    "/unsubscribe": _handle_unsubscribe,
+    "/testrun":     _handle_testrun,
+}
+
+# --- Intents KPI (un lookup en vez de la cadena de elif) ---
+def _intent_status_counts(slots: dict) -> str:
+    # Siempre mostrar el resumen completo del mes, sin filtrar por estado.
+    slots["status"] = None
+    return F.f_status(data.status_counts(slots), slots)
+
+def _intent_tech_by_person(slots: dict) -> str:
+    person = slots.get("technician")
+    if not person:
+        return "¿De qué técnico quieres ver las órdenes? (Andres, Esteban, Juan, Sebastian, Mateo, Jose, Pablo)"
+    # Resumen completo del técnico aunque el texto diga 'abiertas' o 'cerradas'
+    slots.pop("status", None)
+    return F.f_tech_person(person, data.tech_person_counts(slots, person), slots)
+
+_INTENT_HANDLERS = {
+    "MTTR":          lambda s: F.f_mttr(data.kpi_mttr(s), s),
+    "MTBF":          lambda s: F.f_mtbf(data.kpi_mtbf(s), s),
+    "PM_COMPLIANCE": lambda s: F.f_pm(data.kpi_pm_compliance(s), s),
+    "BACKLOG":       lambda s: F.f_backlog(data.kpi_backlog_days(s), s),
+    "COSTS":         lambda s: F.f_costs(data.kpi_costs_monthly(s), s),
+    "TOP_DOWNTIME":  lambda s: F.f_top_dt(data.top_downtime(s), s),
+    "STATUS_COUNTS": _intent_status_counts,
+    "TECH_BY_PERSON": _intent_tech_by_person,
+}
+
 # --- Health / Version ---
 @app.get("/health")
 def health():
@@ -122,7 +236,7 @@ async def telegram_webhook(
     if WEBHOOK_SECRET and x_tg_secret != WEBHOOK_SECRET:
         raise HTTPException(status_code=401, detail="invalid signature")
 
-    body = await req.json()
+    body = orjson.loads(await req.body())
     msg = body.get("message") or {}
     chat_id = (msg.get("chat") or {}).get("id")
     text    = (msg.get("text") or "").strip()
@@ -134,133 +248,44 @@ async def telegram_webhook(
 
     low = text.lower()
 
+    # Contexto NLU único para todo el mensaje (saludo, despedida, intent, slots)
+    ctx = nlu.build_context(text)
+
     # Saludo inmediato
-    if nlu.is_greeting(text):
-        await send_message(chat_id, HELP_TEXT)
+    if ctx.has_greeting:
+        await send_message_cached(chat_id, _HELP_TAIL)
         return {"ok": True}
 
     # Despedida natural
-    if nlu.is_farewell(text):
-        await send_message(chat_id, "¡Gracias! Me alegra ayudarte. Nos vemos mañana 👋")
+    if ctx.has_farewell:
+        await send_message_cached(chat_id, _FAREWELL_TAIL)
         data.update_last_seen(chat_id)
         return {"ok": True}
 
-    # Utilidades
-    if low.startswith("/version"):
-        await send_message(chat_id, version_text())
-        return {"ok": True}
-
-    # --- Comandos de reportes ---
-    if low.startswith("/setreport"):
-        parts = text.split()
-        if len(parts) != 2 or ":" not in parts[1]:
-            await send_message(chat_id, "⚠️ Formato de hora inválido. Usa HH:MM (ej. 07:00).")
-        else:
-            try:
-                hh, mm = map(int, parts[1].split(":"))
-                hhmm = f"{hh:02d}:{mm:02d}"
-                data.set_report_time(chat_id, hhmm)
-                scheduler.add_job(
-                    send_daily_report,
-                    CronTrigger(hour=hh, minute=mm),
-                    args=[chat_id],
-                    id=f"rep_{chat_id}",
-                    replace_existing=True,
-                )
-                await send_message(chat_id, f"⏰ Hora de reporte establecida en {hhmm} (mes en curso).")
-            except Exception:
-                await send_message(chat_id, "⚠️ No pude interpretar esa hora. Usa HH:MM (ej. 07:00).")
-        return {"ok": True}
-
-    if low.startswith("/subscribe"):
-        hhmm = data.get_report_time(chat_id) or "07:00"
-        hh, mm = map(int, hhmm.split(":"))
-        data.set_report_time(chat_id, hhmm)
-        scheduler.add_job(
-            send_daily_report,
-            CronTrigger(hour=hh, minute=mm),
-            args=[chat_id],
-            id=f"rep_{chat_id}",
-            replace_existing=True,
-        )
-        await send_message(
-            chat_id,
-            f"🔔 Suscripción activada. Enviaré el reporte diario (mes en curso) a la hora configurada ({hhmm})."
-        )
-        return {"ok": True}
-
-    if low.startswith("/unsubscribe"):
-        job = scheduler.get_job(f"rep_{chat_id}")
-        if job:
-            scheduler.remove_job(job.id)
-        data.set_report_time(chat_id, None)
-        await send_message(chat_id, "🔕 Suscripción cancelada. Ya no enviaré reportes diarios.")
-        return {"ok": True}
-
-    if low.startswith("/testrun"):
-        await send_daily_report(chat_id)
-        return {"ok": True}
+    # --- Comandos (/version, /setreport, /subscribe, ...) ---
+    if low.startswith("/"):
+        handler = _CMD_HANDLERS.get(low.split()[0].split("@", 1)[0])
+        if handler:
+            await handler(chat_id, text)
+            return {"ok": True}
 
     # --- NLU/Slots ---
     sites, areas = data.query_known_values()
-    intent = nlu.detect_intent(text)
-    slots  = nlu.extract_slots(text, sites, areas)
+    intent = nlu.detect_intent_ctx(ctx)
+    slots  = nlu.extract_slots_ctx(ctx, sites, areas)
 
-    # Si no hay rango, por defecto “mes actual” (1..hoy)
-    def _ensure_month_default(s: dict):
-        if not s.get("date_from") and not s.get("date_to"):
-            today = datetime.utcnow().date()
-            start = today.replace(day=1)
-            s["date_from"] = start.isoformat()
-            s["date_to"]   = today.isoformat()
+    # Fechas del request calculadas UNA vez (las usan el default de rango
+    # y los formatters, en vez de repetir utcnow()+isoformat por helper)
+    today = datetime.utcnow().date()
+    today_iso = today.isoformat()
+    month_start_iso = today.replace(day=1).isoformat()
 
     # --- Intent routing ---
-    if intent in {
-        "MTTR", "MTBF", "PM_COMPLIANCE", "BACKLOG",
-        "COSTS", "TOP_DOWNTIME", "STATUS_COUNTS", "TECH_BY_PERSON"
-    }:
-        _ensure_month_default(slots)
-
-    if intent == "MTTR":
-        out = F.f_mttr(data.kpi_mttr(slots), slots)
-
-    elif intent == "MTBF":
-        out = F.f_mtbf(data.kpi_mtbf(slots), slots)
-
-    elif intent == "PM_COMPLIANCE":
-        out = F.f_pm(data.kpi_pm_compliance(slots), slots)
-
-    elif intent == "BACKLOG":
-        out = F.f_backlog(data.kpi_backlog_days(slots), slots)
-
-    elif intent == "COSTS":
-        out = F.f_costs(data.kpi_costs_monthly(slots), slots)
-
-    elif intent == "TOP_DOWNTIME":
-        out = F.f_top_dt(data.top_downtime(slots), slots)
-
-    elif intent == "STATUS_COUNTS":
-        # Siempre mostrar el resumen completo del mes, sin filtrar por estado.
-        slots["status"] = None
-        out = F.f_status(data.status_counts(slots), slots)
-
-    elif intent == "TECH_BY_PERSON":
-        person = slots.get("technician")
-        if not person:
-            out = "¿De qué técnico quieres ver las órdenes? (Andres, Esteban, Juan, Sebastian, Mateo, Jose, Pablo)"
-        else:
-            # Resumen completo del técnico aunque el texto diga 'abiertas' o 'cerradas'
-            slots.pop("status", None)
-            counts = data.tech_person_counts(slots, person)
-            out = F.f_tech_person(person, counts, slots)
-
-    else:
-        out = (
-            "Lo siento, no puedo ayudarte con esa solicitud. Por ahora solo puedo apoyar con: "
-            "MTTR, MTBF, Backlog, Cumplimiento PM, Costos, Top downtime, Estados y órdenes por técnico.\n\n"
-            "Ejemplos:\n• MTTR este mes\n• MTBF este mes\n• Costos septiembre\n• Cumplimiento PM agosto\n"
-            "• ¿Cuántas órdenes cerradas tiene Sebastian en septiembre?"
-        )
+    handler = _INTENT_HANDLERS.get(intent)
+    if not handler:
+        await send_message_cached(chat_id, _UNKNOWN_TAIL)
+        return {"ok": True}
 
-    await send_message(chat_id, out)
+    _ensure_month_default(slots, month_start_iso, today_iso)
+    await send_message(chat_id, handler(slots))
     return {"ok": True}
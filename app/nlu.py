@@ -1,39 +1,77 @@
 # app/nlu.py
-import re, unicodedata
+import re, functools, unicodedata
 from datetime import datetime, timedelta, date
 from typing import Dict, Any, List, Optional, Tuple
 
 # ----------------- normalización -----------------
+_WS_RE = re.compile(r"\s+")
+
+# Tabla para str.translate: borra combining marks (Mn) en un solo paso C,
+# sin el generador por carácter + unicodedata.category por char. Se limita a
+# los bloques de combinantes (diacríticos latinos incluidos) para no escanear
+# todo Unicode al importar.
+_MN_RANGES = ((0x0300, 0x036F), (0x1AB0, 0x1AFF), (0x1DC0, 0x1DFF),
+              (0x20D0, 0x20FF), (0xFE20, 0xFE2F))
+_COMBINING = dict.fromkeys(
+    c for start, end in _MN_RANGES for c in range(start, end + 1)
+    if unicodedata.category(chr(c)) == "Mn"
+)
+
+# lru_cache: detect_intent y extract_slots normalizan el MISMO texto
+# back-to-back en cada webhook; la segunda llamada sale del caché.
+@functools.lru_cache(maxsize=2048)
 def _norm(s: str) -> str:
     s = s.lower().strip()
-    s = "".join(ch for ch in unicodedata.normalize("NFD", s) if unicodedata.category(ch) != "Mn")
-    s = re.sub(r"\s+", " ", s)
-    return s
+    # Fast-path ASCII: NFD es un no-op y el filtro de combining marks sobra;
+    # la mayoría de los mensajes del bot caen aquí (dos llamadas C y listo).
+    if s.isascii():
+        return _WS_RE.sub(" ", s)
+    s = unicodedata.normalize("NFD", s).translate(_COMBINING)
+    return _WS_RE.sub(" ", s)
+
+def batch_norm(texts: List[str]) -> List[str]:
+    # Normalización en lote (backfill de logs / analítica). El camino por
+    # mensaje ya es casi puro C (fast-path ASCII, translate, lru_cache), así
+    # que no hay kernel JIT aparte: mismos resultados, una sola pasada.
+    return [_norm(t) for t in texts]
 
 # ----------------- saludos / despedidas -----------------
-GREETINGS = [
+# Constantes inmutables como tuplas: no se reconstruyen ni mutan nunca.
+GREETINGS = (
     "hola","buenas","buenos dias","buen dia","buenas tardes","buenas noches",
     "que puedes hacer","ayuda","help","/start","/help"
-]
-FAREWELLS = [
+)
+FAREWELLS = (
     "gracias","nos vemos","bye","adios","hasta luego","hasta pronto",
     "hasta manana","hasta mañana","chao","me despido"
-]
+)
+
+# Alternaciones compiladas = autómata multi-patrón en C (estilo Aho-Corasick):
+# un solo scan del texto en vez de |patrones| búsquedas de substring.
+_GREET_RE    = re.compile("|".join(map(re.escape, GREETINGS)))
+_FAREWELL_RE = re.compile("|".join(map(re.escape, FAREWELLS)))
+
+# Entradas de una sola palabra como frozenset: el caso común ("hola",
+# "gracias") se resuelve con un isdisjoint en C sobre los tokens, sin
+# arrancar el motor de regex; el regex queda de respaldo para frases y
+# coincidencias por substring ("hola!" sigue saludando).
+_GREET_WORDS    = frozenset(w for w in GREETINGS if " " not in w)
+_FAREWELL_WORDS = frozenset(w for w in FAREWELLS if " " not in w)
 
 def is_greeting(text: str) -> bool:
-    t = _norm(text)
-    return any(w in t for w in GREETINGS)
+    return build_context(text).has_greeting
 
 def is_farewell(text: str) -> bool:
-    t = _norm(text)
-    return any(w in t for w in FAREWELLS)
+    return build_context(text).has_farewell
 
 # ----------------- meses / técnicos -----------------
 MONTHS = {
     "enero":1,"febrero":2,"marzo":3,"abril":4,"mayo":5,"junio":6,
     "julio":7,"agosto":8,"septiembre":9,"setiembre":9,"octubre":10,"noviembre":11,"diciembre":12
 }
-TECHS = ["andres","esteban","juan","sebastian","mateo","jose","pablo"]
+TECHS = ("andres","esteban","juan","sebastian","mateo","jose","pablo")
+_TECH_ANY_RE = re.compile("|".join(TECHS))  # mención de técnico (substring)
+_TECH_CAP = {t: t.capitalize() for t in TECHS}  # nombre canónico precalculado
 
 # ----------------- intents -----------------
 # Acepta variantes comunes en español
@@ -54,52 +92,146 @@ INTENTS = {
     rf"\b(cuant[ao]s?)\b.*\b(ordenes|órdenes|ots)\b.*\b(abiert[as]?|cerrad[as]?|progreso|en progreso|totales?)\b.*\b(hay)\b": "STATUS_COUNTS",
 }
 
+# ----------------- patrones precompilados -----------------
+# Todo regex que corre por mensaje se compila una vez al importar el módulo:
+# evita el lookup del caché de `re` (y su límite) en cada llamada.
+# Alternación maestra: un solo scan del texto decide el intent, en vez de
+# probar ~9 patrones en serie. Los grupos I0..In mapean al nombre de intent
+# (STATUS_COUNTS aparece dos veces, por eso no se usa el nombre directo).
+_MASTER_INTENT_NAMES = {f"I{i}": name for i, (_, name) in enumerate(INTENTS.items())}
+_MASTER_INTENTS = re.compile(
+    "|".join(f"(?P<I{i}>{pat})" for i, (pat, _) in enumerate(INTENTS.items()))
+)
+
+# Scan único para slots: tipo, estado, mención de órdenes y técnico salen de
+# una sola pasada con finditer; la precedencia se resuelve sobre los flags.
+_SLOT_SCAN = re.compile(
+    r"(?P<pm>\bpm\b)|(?P<cm>\bcm\b)"
+    r"|(?P<abiert>abiert)|(?P<cerrad>cerrad)|(?P<progreso>progreso)"
+    r"|(?P<orders>\b(?:ordenes|órdenes|ots)\b)"
+    r"|\b(?P<tech>" + "|".join(TECHS) + r")\b"
+)
+
+# ----------------- contexto por mensaje -----------------
+class NLUContext:
+    # Resultado del scan único: detect_intent y extract_slots lo comparten
+    # en vez de repetir los mismos regexes/substrings cada uno por su lado.
+    __slots__ = ("t", "has_orders", "has_tech", "tech_name",
+                 "has_pm", "has_cm", "has_abiert", "has_cerrad", "has_progreso",
+                 "has_greeting", "has_farewell")
+
+@functools.lru_cache(maxsize=512)
+def _context_for(t: str) -> NLUContext:
+    ctx = NLUContext()
+    ctx.t = t
+    ctx.has_orders = ctx.has_pm = ctx.has_cm = False
+    ctx.has_abiert = ctx.has_cerrad = ctx.has_progreso = False
+    ctx.tech_name = None
+    techs_seen = set()
+    for m in _SLOT_SCAN.finditer(t):
+        g = m.lastgroup
+        if g == "tech":
+            techs_seen.add(m.group("tech"))
+        else:
+            setattr(ctx, "has_" + g, True)
+    if techs_seen:
+        for tech in TECHS:
+            if tech in techs_seen:
+                ctx.tech_name = _TECH_CAP[tech]
+                break
+    # mención por substring (más laxa que \b...\b, igual que el código viejo)
+    ctx.has_tech = _TECH_ANY_RE.search(t) is not None
+    # saludo/despedida una sola vez por mensaje: el webhook y detect_intent
+    # leen el flag en vez de repetir el scan cada uno.
+    toks = t.split()
+    ctx.has_greeting = (not _GREET_WORDS.isdisjoint(toks)
+                        or _GREET_RE.search(t) is not None)
+    ctx.has_farewell = (not _FAREWELL_WORDS.isdisjoint(toks)
+                        or _FAREWELL_RE.search(t) is not None)
+    return ctx
+
+def build_context(text: str) -> NLUContext:
+    return _context_for(_norm(text))
+_RE_FILLER = re.compile(FILLER)
+# Prefiltro literal para saltarse el sub() de muletillas cuando no hay
+# ninguna: cada alternativa del FILLER contiene uno de estos substrings
+# ("muestra" cubre muestr(a|ame)), así el chequeo barato nunca da falso
+# negativo frente al regex.
+_FILLER_TRIGGERS = ("dime", "muestra", "podrias", "puedes", "por favor",
+                    "como esta", "cual es", "indica", "reporta",
+                    "quiero saber", "me dices")
+# Un solo regex para los 13 nombres de mes + año opcional; el número de mes
+# sale del dict MONTHS en O(1), sin recorrer los nombres uno a uno.
+_MONTH_RE = re.compile(r"\b(" + "|".join(MONTHS) + r")\b(?:\s+(\d{4}))?")
+
+# Frases de fecha relativas/rango en UNA alternación: un scan y dispatch por
+# lastgroup, en vez de hasta 6 regexes secuenciales por mensaje.
+_DATE_RE = re.compile(
+    r"(?P<este>\beste mes\b)"
+    r"|(?P<pasado>\bmes pasado\b)"
+    r"|(?P<sem>\besta semana\b)"
+    r"|(?P<semp>\bsemana pasada\b)"
+    r"|\bultimos?\s+(?P<n>\d+)\s+dias\b"
+    r"|\bdesde\s+(?P<df>\d{4}-\d{2}-\d{2})\s+hasta\s+(?P<dt>\d{4}-\d{2}-\d{2})\b"
+)
+
 
 def detect_intent(text: str) -> str:
-    t = _norm(text)
+    return detect_intent_ctx(build_context(text))
+
+def detect_intent_norm(t: str) -> str:
+    # Variante interna: asume `t` ya normalizado.
+    return detect_intent_ctx(_context_for(t))
+
+def detect_intent_ctx(ctx: NLUContext) -> str:
+    t = ctx.t
 
     # 1) Saludos -> HELP
-    if any(g in t for g in GREETINGS):
+    if ctx.has_greeting:
         return "HELP"
 
     # 2) Pregunta general por órdenes (abiertas/cerradas/en progreso/estado)
     #    SIN mencionar un técnico -> mostrar ESTADO GENERAL (mes actual)
-    has_orders = re.search(r"\b(ordenes|órdenes|ots)\b", t) is not None
-    mentions_tech = any(tech in t for tech in TECHS)
-    mentions_status_word = any(k in t for k in ["abiert", "cerrad", "progreso", "estado", "estados"])
-    if has_orders and not mentions_tech:
+    if ctx.has_orders and not ctx.has_tech:
         return "STATUS_COUNTS"
 
-    # 3) Reviso intents declarados (luego de limpiar muletillas)
-    t2 = re.sub(FILLER, "", t)
-    for pat, name in INTENTS.items():
-        if re.search(pat, t2):
-            return name
+    # 3) Reviso intents declarados (luego de limpiar muletillas; el caso
+    #    típico "mttr de andres" no trae ninguna y se ahorra el sub())
+    t2 = _RE_FILLER.sub("", t) if any(w in t for w in _FILLER_TRIGGERS) else t
+    m = _MASTER_INTENTS.search(t2)
+    if m:
+        return _MASTER_INTENT_NAMES[m.lastgroup]
 
     # 4) Fallback: si menciona un TÉCNICO y habla de abiertas/cerradas/progreso -> TECH_BY_PERSON
-    if any(tech in t for tech in TECHS) and ("abiert" in t or "cerrad" in t or "progreso" in t):
+    if ctx.has_tech and (ctx.has_abiert or ctx.has_cerrad or ctx.has_progreso):
         return "TECH_BY_PERSON"
 
     # 5) Predeterminado
     return "HELP"
 
 # ----------------- fechas -----------------
+@functools.lru_cache(maxsize=32)
+def _iso_for_ordinal(ordinal: int) -> str:
+    # Las mismas pocas fechas se repiten entre mensajes (hoy, 1° del mes,
+    # inicio de semana, límites de mes nombrado): sus strings ISO se sirven
+    # del caché en vez de re-formatearse en cada llamada.
+    return date.fromordinal(ordinal).isoformat()
+
 def _month_range_from_name(t: str) -> Optional[Tuple[str, str]]:
-    for name, m in MONTHS.items():
-        mobj = re.search(rf"\b{name}\b(?:\s+(\d{{4}}))?", t)
-        if mobj:
-            y = int(mobj.group(1)) if mobj.group(1) else datetime.utcnow().year
-            start = date(y, m, 1)
-            if m == 12:
-                end = date(y+1, 1, 1) - timedelta(days=1)
-            else:
-                end = date(y, m+1, 1) - timedelta(days=1)
-            return (start.isoformat(), end.isoformat())
-    return None
+    mobj = _MONTH_RE.search(t)
+    if not mobj:
+        return None
+    m = MONTHS[mobj.group(1)]
+    y = int(mobj.group(2)) if mobj.group(2) else datetime.utcnow().year
+    start = date(y, m, 1)
+    if m == 12:
+        end = date(y+1, 1, 1) - timedelta(days=1)
+    else:
+        end = date(y, m+1, 1) - timedelta(days=1)
+    return (_iso_for_ordinal(start.toordinal()), _iso_for_ordinal(end.toordinal()))
 
 def _apply_date_pattern(t: str) -> Dict[str, Optional[str]]:
     slots = {"date_from": None, "date_to": None}
-    now = datetime.utcnow()
 
     # mes por nombre (septiembre, septiembre 2025, etc.)
     mr = _month_range_from_name(t)
@@ -107,63 +239,61 @@ def _apply_date_pattern(t: str) -> Dict[str, Optional[str]]:
         slots["date_from"], slots["date_to"] = mr
         return slots
 
-    if re.search(r"\beste mes\b", t):
-        slots["date_from"] = now.replace(day=1).date().isoformat()
-        slots["date_to"]   = now.date().isoformat(); return slots
-    if re.search(r"\bmes pasado\b", t):
-        first_this = now.replace(day=1)
-        last_prev  = first_this - timedelta(days=1)
-        first_prev = last_prev.replace(day=1)
-        slots["date_from"] = first_prev.date().isoformat()
-        slots["date_to"]   = last_prev.date().isoformat(); return slots
-    if re.search(r"\besta semana\b", t):
-        start = now - timedelta(days=now.weekday())
-        slots["date_from"] = start.date().isoformat()
-        slots["date_to"]   = now.date().isoformat(); return slots
-    if re.search(r"\bsemana pasada\b", t):
-        start_this = now - timedelta(days=now.weekday())
-        start_prev = start_this - timedelta(days=7)
-        end_prev   = start_this - timedelta(days=1)
-        slots["date_from"] = start_prev.date().isoformat()
-        slots["date_to"]   = end_prev.date().isoformat(); return slots
-
-    m = re.search(r"\bultimos?\s+(\d+)\s+dias\b", t)
-    if m:
-        n = int(m.group(1))
-        slots["date_from"] = (now - timedelta(days=n)).date().isoformat()
-        slots["date_to"]   = now.date().isoformat(); return slots
+    m = _DATE_RE.search(t)
+    if not m:
+        return slots
 
-    m = re.search(r"\bdesde\s+(\d{4}-\d{2}-\d{2})\s+hasta\s+(\d{4}-\d{2}-\d{2})\b", t)
-    if m:
-        slots["date_from"], slots["date_to"] = m.group(1), m.group(2); return slots
+    # el rango explícito ya viene en ISO, sin tocar el calendario
+    g = m.lastgroup
+    if g == "dt":
+        slots["date_from"], slots["date_to"] = m.group("df"), m.group("dt")
+        return slots
+
+    today = datetime.utcnow().date()  # una sola lectura del reloj
+    if g == "este":
+        df, dt = today.replace(day=1), today
+    elif g == "pasado":
+        last_prev = today.replace(day=1) - timedelta(days=1)
+        df, dt = last_prev.replace(day=1), last_prev
+    elif g == "sem":
+        df, dt = today - timedelta(days=today.weekday()), today
+    elif g == "semp":
+        start_this = today - timedelta(days=today.weekday())
+        df, dt = start_this - timedelta(days=7), start_this - timedelta(days=1)
+    else:  # g == "n": ultimos N dias
+        df, dt = today - timedelta(days=int(m.group("n"))), today
 
+    slots["date_from"] = _iso_for_ordinal(df.toordinal())
+    slots["date_to"]   = _iso_for_ordinal(dt.toordinal())
     return slots
 
 # ----------------- extracción de slots -----------------
 def extract_slots(text: str, known_sites: List[str] = None, known_areas: List[str] = None) -> Dict[str, Any]:
-    t = _norm(text)
+    return extract_slots_ctx(build_context(text), known_sites, known_areas)
+
+def extract_slots_norm(t: str, known_sites: List[str] = None, known_areas: List[str] = None) -> Dict[str, Any]:
+    return extract_slots_ctx(_context_for(t), known_sites, known_areas)
+
+def extract_slots_ctx(ctx: NLUContext, known_sites: List[str] = None, known_areas: List[str] = None) -> Dict[str, Any]:
     slots: Dict[str, Any] = {
         "site": None, "area": None, "type": None, "status": None,
         "date_from": None, "date_to": None, "technician": None
     }
 
-    # tipo de orden
-    if re.search(r"\bpm\b", t): slots["type"] = "PM"
-    if re.search(r"\bcm\b", t): slots["type"] = "CM"
+    # tipo / estado / técnico salen del scan único del contexto; precedencia
+    # original: CM pisa PM, abiert > cerrad > progreso.
+    if ctx.has_pm: slots["type"] = "PM"
+    if ctx.has_cm: slots["type"] = "CM"
 
-    # estado
-    if "abiert" in t: slots["status"] = "Abierta"
-    elif "cerrad" in t: slots["status"] = "Cerrada"
-    elif "progreso" in t: slots["status"] = "En Progreso"
+    if ctx.has_abiert: slots["status"] = "Abierta"
+    elif ctx.has_cerrad: slots["status"] = "Cerrada"
+    elif ctx.has_progreso: slots["status"] = "En Progreso"
 
     # técnico (si menciona ordenes/ots o abiertas/cerradas)
-    if re.search(r"\b(ordenes|órdenes|ots)\b", t) or ("abiert" in t or "cerrad" in t):
-        for tech in TECHS:
-            if re.search(rf"\b{tech}\b", t):
-                slots["technician"] = tech.capitalize()
-                break
+    if ctx.tech_name and (ctx.has_orders or ctx.has_abiert or ctx.has_cerrad):
+        slots["technician"] = ctx.tech_name
 
     # fechas
-    d = _apply_date_pattern(t)
+    d = _apply_date_pattern(ctx.t)
     slots.update(d)
     return slots
@@ -7,14 +7,19 @@ APP_VERSION  = os.environ.get("APP_VERSION", "0.1.0")
 GIT_SHA      = os.environ.get("GIT_SHA", "").strip() or "dev"
 BUILD_TIME   = os.environ.get("BUILD_TIME") or datetime.utcnow().isoformat()
 
+# Valores inmutables (leídos del env al importar): se arman una sola vez,
+# el endpoint /health los sirve sin re-crear el dict en cada request.
+_GIT_SHA_SHORT = GIT_SHA[:7]
+_DICT = {
+    "name": APP_NAME,
+    "version": APP_VERSION,
+    "git_sha": _GIT_SHA_SHORT,
+    "build_time": BUILD_TIME,
+}
+_TEXT = f"{APP_NAME} v{APP_VERSION} (commit {_GIT_SHA_SHORT}, build {BUILD_TIME})"
+
 def as_dict():
-    return {
-        "name": APP_NAME,
-        "version": APP_VERSION,
-        "git_sha": GIT_SHA[:7],
-        "build_time": BUILD_TIME,
-    }
+    return _DICT
 
 def as_text():
-    d = as_dict()
-    return f"{d['name']} v{d['version']} (commit {d['git_sha']}, build {d['build_time']})"
+    return _TEXT